@@ -1,13 +1,20 @@
+import base64
+import gzip
 import json
 import logging
 import os
+import re
+import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from string import Template
 
 from parsl.dataflow.error import ConfigurationError
-from parsl.providers.azure.template import template_string
+from parsl.providers.azure.address_space import AddressSpaceManager
+from parsl.providers.azure.template import template_string, bootstrap_string, log_fetch_string
 from parsl.providers.provider_base import ExecutionProvider
-from parsl.providers.error import OptionalModuleMissing
+from parsl.providers.error import OptionalModuleMissing, ScalingFailed
 from parsl.utils import RepresentationMixin
 from parsl.launchers import SingleNodeLauncher
 
@@ -36,6 +43,23 @@ translate_table = {
     'VM stopped': 'COMPLETED',  # We shouldn't really see this state
 }
 
+# Resource id of an IP configuration that belongs to a NIC
+_nic_ip_config_id = re.compile(
+    r'.*/resourceGroups/([^/]+)/providers/Microsoft\.Network/networkInterfaces/([^/]+)'
+    r'/ipConfigurations/([^/]+)$', re.IGNORECASE)
+
+# Where the bootstrap script writes the worker's stdout and stderr on the VM
+REMOTE_LOG_DIR = '/var/log/parsl'
+
+# RunShellScript only returns the last 4096 bytes of output, which has to hold
+# one encoded chunk of each of stdout and stderr.
+LOG_MAX_ENCODED = 1900
+
+# Give up on a VM's logs after this many failed fetches in a row
+LOG_MAX_ERRORS = 3
+
+_log_line = re.compile(r'^parsl-log (stdout|stderr) (\d+) ([A-Za-z0-9+/=]*)$', re.MULTILINE)
+
 
 class AzureProvider(ExecutionProvider, RepresentationMixin):
     """
@@ -105,6 +129,31 @@ class AzureProvider(ExecutionProvider, RepresentationMixin):
     linger : Bool
         When set to True, the workers will not `halt`. The user is responsible for shutting
         down the nodes.
+    vnet_address_space : str
+        CIDR of the virtual network that instances are placed in. Default is '10.0.0.0/16'.
+    subnet_prefix_length : int
+        Size of each subnet carved from `vnet_address_space`. Default is 20.
+    subnet_headroom : int
+        A new subnet is created once fewer than this many private IPs remain free.
+        Default is 64.
+    log_dir : str
+        Local directory to stream each VM's bootstrap and worker output into, as
+        `<job_id>.stdout`, `<job_id>.stderr` and `<job_id>.runcommand.log`.
+        Default is None, which disables log collection.
+    log_interval : int
+        Seconds between log fetches. Default is 60.
+    log_chunk_size : int
+        Maximum number of bytes of each stream fetched from a VM per fetch. Default is 4096.
+        RunCommand output is small, so a chunk is halved until it fits in
+        `LOG_MAX_ENCODED` characters once gzipped and base64 encoded. In practice a
+        fetch returns 2-4 KB of text, or about 1 KB of output that doesn't compress.
+    log_fetches_per_poll : int
+        Maximum number of fetches from a VM per poll while it is behind. Default is 4.
+    log_drain_timeout : int
+        Seconds `cancel` spends collecting the rest of the logs of the jobs being
+        cancelled. Whatever is left uncollected is logged. Default is 60.
+    log_fetch_workers : int
+        Number of VMs to fetch logs from concurrently. Default is 16.
     """
 
     def __init__(self,
@@ -120,7 +169,16 @@ class AzureProvider(ExecutionProvider, RepresentationMixin):
                  key_file=None,
                  vnet_name="parsl.auto",
                  linger=False,
-                 launcher=SingleNodeLauncher()):
+                 launcher=SingleNodeLauncher(),
+                 vnet_address_space='10.0.0.0/16',
+                 subnet_prefix_length=20,
+                 subnet_headroom=64,
+                 log_dir=None,
+                 log_interval=60,
+                 log_chunk_size=4096,
+                 log_fetches_per_poll=4,
+                 log_drain_timeout=60,
+                 log_fetch_workers=16):
         if not _api_enabled:
             raise OptionalModuleMissing(
                 ['azure', 'msrestazure'], "Azure Provider requires the azure module.")
@@ -147,6 +205,23 @@ class AzureProvider(ExecutionProvider, RepresentationMixin):
         self.linger = linger
         self.resources = {}
         self.instances = []
+        try:
+            self.address_space = AddressSpaceManager(vnet_address_space,
+                                                     subnet_prefix_length,
+                                                     subnet_headroom)
+        except ValueError as e:
+            raise ConfigurationError(str(e))
+        self._network_ready = False
+
+        self.log_dir = log_dir
+        self.log_interval = log_interval
+        self.log_chunk_size = log_chunk_size
+        self.log_fetches_per_poll = log_fetches_per_poll
+        self.log_drain_timeout = log_drain_timeout
+        self.log_fetch_workers = log_fetch_workers
+        self._log_thread = None
+        if log_dir is not None:
+            os.makedirs(log_dir, exist_ok=True)
 
         env_specified = os.getenv("AZURE_CLIENT_ID") is not None and os.getenv(
             "AZURE_CLIENT_SECRET") is not None and os.getenv(
@@ -248,13 +323,22 @@ class AzureProvider(ExecutionProvider, RepresentationMixin):
         # Uniqueness strategy from AWS provider
         job_name = "{0}-parsl-auto".format(str(time.time()).replace(".", ""))
 
-        async_vm_creation = self.compute_client.\
-            virtual_machines.create_or_update(
-                self.vnet_name, job_name, vm_parameters)
+        try:
+            async_vm_creation = self.compute_client.\
+                virtual_machines.create_or_update(
+                    self.vnet_name, job_name, vm_parameters)
 
-        vm_info = async_vm_creation.result()
+            vm_info = async_vm_creation.result()
+        except Exception:
+            try:
+                self.delete_nic(nic)
+            except Exception:
+                logger.exception("Failed to delete NIC {}".format(nic.name))
+            raise
         self.instances.append(vm_info.name)
 
+        self.resources.setdefault("job_nics", {})[vm_info.name] = nic
+
         try:
 
             logger.debug("Started instance_id: {0}".format(vm_info.id))
@@ -287,14 +371,19 @@ class AzureProvider(ExecutionProvider, RepresentationMixin):
             async_vm_start.wait()
 
             logger.debug("attempting to connect instance to Parsl master")
+            bootstrap_str = Template(bootstrap_string).substitute(log_dir=REMOTE_LOG_DIR,
+                                                                  script=cmd_str)
             run_command_parameters = {
                                         'command_id': 'RunShellScript',
-                                        'script': cmd_str.split("\n")
+                                        'script': bootstrap_str.split("\n")
                                     }
-            self.compute_client.virtual_machines.run_command(
+            async_run_command = self.compute_client.virtual_machines.run_command(
                                             self.group_name,
                                             vm_info.name,
                                             run_command_parameters)
+
+            if self.log_dir is not None:
+                self.track_logs(vm_info.name, async_run_command)
         except KeyboardInterrupt:
             self.cancel([vm_info.name])
             raise KeyboardInterrupt
@@ -343,6 +432,18 @@ class AzureProvider(ExecutionProvider, RepresentationMixin):
             logger.debug("Ignoring cancel requests due to linger mode")
             return [False for x in job_ids]
 
+        if self.log_dir is not None:
+            try:
+                remaining = self.drain_logs(job_ids)
+            except Exception:
+                logger.exception("Failed to collect final logs")
+                remaining = {}
+            for job_id in job_ids:
+                if remaining.get(job_id):
+                    logger.warning("{} bytes of logs of {} were not collected".format(
+                        remaining[job_id], job_id))
+                self.close_logs(job_id)
+
         for job_id in job_ids:
             try:
                 logger.debug('Delete VM {}'.format(job_id))
@@ -353,6 +454,14 @@ class AzureProvider(ExecutionProvider, RepresentationMixin):
                 return_vals.append(True)
             except Exception:
                 return_vals.append(False)
+                continue
+
+            nic_info = self.resources.get("job_nics", {}).pop(job_id, None)
+            if nic_info is not None:
+                try:
+                    self.delete_nic(nic_info)
+                except Exception:
+                    logger.exception("Failed to delete NIC {} of {}".format(nic_info.name, job_id))
 
         return return_vals
 
@@ -369,18 +478,299 @@ class AzureProvider(ExecutionProvider, RepresentationMixin):
         """Returns the current blocksize."""
         return len(self.instances)
 
+    def track_logs(self, job_id, bootstrap):
+        """Start collecting the logs of a job.
+
+        Parameters
+        ----------
+        job_id : str
+            Identifier for the job.
+        bootstrap : LROPoller
+            The RunCommand that started the bootstrap script.
+        """
+        self.resources.setdefault("logs", {})[job_id] = {
+            "bootstrap": bootstrap,
+            "bootstrap_saved": False,
+            "lock": threading.Lock(),
+            "closed": False,
+            "errors": 0,
+            "offsets": {"stdout": 0, "stderr": 0},
+            "sizes": {"stdout": None, "stderr": None}
+        }
+        self.start_log_collection()
+
+    def start_log_collection(self):
+        """Start the background thread that streams worker logs into `log_dir`.
+        """
+        if self.log_dir is None or self._log_thread is not None:
+            return
+        self._log_thread = threading.Thread(target=self._log_loop,
+                                            name="azure-log-collector")
+        self._log_thread.daemon = True
+        self._log_thread.start()
+
+    def _log_loop(self):
+        while True:
+            time.sleep(self.log_interval)
+            try:
+                self.collect_logs()
+            except Exception:
+                logger.exception("Failed to collect worker logs")
+
+    def collect_logs(self, job_ids=None):
+        """Fetch new bootstrap and worker output from VMs into `log_dir`.
+
+        Each call makes up to `log_fetches_per_poll` fetches per VM while it is behind,
+        appending to the local files where the previous fetch left off. Collection stops
+        for a VM once its logs are drained and it is no longer running, or after
+        `LOG_MAX_ERRORS` failed fetches in a row.
+
+        Parameters
+        ----------
+        job_ids : list of str
+            Identifiers for the jobs. Default is every job with logs being collected.
+        Returns
+        -------
+        dict
+            Number of bytes fetched for each job.
+        """
+        logs = self.resources.get("logs", {})
+        if job_ids is None:
+            job_ids = list(logs.keys())
+        job_ids = [job_id for job_id in job_ids if job_id in logs]
+
+        with ThreadPoolExecutor(max_workers=self.log_fetch_workers) as pool:
+            fetched = pool.map(lambda job_id: self._fetch_logs(job_id, self.log_fetches_per_poll),
+                               job_ids)
+            return dict(zip(job_ids, fetched))
+
+    def drain_logs(self, job_ids, timeout=None):
+        """Fetch logs until everything written so far has been collected, or time runs out.
+
+        Parameters
+        ----------
+        job_ids : list of str
+            Identifiers for the jobs.
+        timeout : float
+            Seconds to keep fetching for, shared by all jobs. Default is `log_drain_timeout`.
+        Returns
+        -------
+        dict
+            Number of bytes left uncollected for each job, counted up to the remote sizes
+            reported by the first fetch. None if the remote sizes are not known.
+        """
+        if timeout is None:
+            timeout = self.log_drain_timeout
+        deadline = time.time() + timeout
+
+        with ThreadPoolExecutor(max_workers=self.log_fetch_workers) as pool:
+            remaining = pool.map(lambda job_id: self._drain_logs(job_id, deadline), job_ids)
+            return dict(zip(job_ids, remaining))
+
+    def _drain_logs(self, job_id, deadline):
+        state = self.resources.get("logs", {}).get(job_id)
+        if state is None:
+            return None
+        fetched = self._fetch_logs(job_id)
+        target = dict(state["sizes"])
+        while fetched > 0 and self._logs_behind(state, target) and time.time() < deadline:
+            fetched = self._fetch_logs(job_id)
+        return self._logs_behind(state, target)
+
+    def close_logs(self, job_id):
+        """Stop collecting logs for a job.
+        """
+        state = self.resources.get("logs", {}).get(job_id)
+        if state is not None:
+            with state["lock"]:
+                self._close_logs_locked(job_id, state)
+
+    def _close_logs_locked(self, job_id, state):
+        state["closed"] = True
+        state["bootstrap"] = None
+        self.resources.get("logs", {}).pop(job_id, None)
+
+    def _logs_behind(self, state, sizes=None):
+        sizes = sizes or state["sizes"]
+        if any(size is None for size in sizes.values()):
+            return None
+        return sum(max(0, sizes[stream] - state["offsets"][stream]) for stream in sizes)
+
+    def _fetch_logs(self, job_id, max_fetches=1):
+        state = self.resources.get("logs", {}).get(job_id)
+        if state is None:
+            return 0
+        fetched = 0
+        with state["lock"]:
+            for _ in range(max_fetches):
+                if state["closed"]:
+                    return fetched
+                chunk = self._fetch_logs_locked(job_id, state)
+                fetched += chunk
+                if chunk == 0 or not self._logs_behind(state):
+                    break
+            if (not state["closed"] and fetched == 0 and self._logs_behind(state) == 0
+                    and not self._vm_running(job_id)):
+                logger.debug("Logs of {} are drained and its VM is gone".format(job_id))
+                self._close_logs_locked(job_id, state)
+        return fetched
+
+    def _vm_running(self, job_id):
+        try:
+            return self.status([job_id])[0] != 'COMPLETED'
+        except CloudError:
+            return False
+
+    def _fetch_logs_locked(self, job_id, state):
+        # The RunCommand extension runs one command at a time per VM
+        if not state["bootstrap"].done():
+            return 0
+
+        if not state["bootstrap_saved"]:
+            try:
+                result = state["bootstrap"].result()
+                message = "\n".join(status.message or '' for status in result.value or [])
+            except Exception as e:
+                message = "Bootstrap RunCommand failed: {}".format(e)
+            with open(os.path.join(self.log_dir, "{}.runcommand.log".format(job_id)), 'w') as f:
+                f.write(message)
+            state["bootstrap_saved"] = True
+
+        offsets = state["offsets"]
+        run_command_parameters = {
+            'command_id': 'RunShellScript',
+            'script': log_fetch_string.format(log_dir=REMOTE_LOG_DIR,
+                                              chunk_size=self.log_chunk_size,
+                                              max_encoded=LOG_MAX_ENCODED,
+                                              stdout_offset=offsets["stdout"],
+                                              stderr_offset=offsets["stderr"]).split("\n")
+        }
+        try:
+            result = self.compute_client.virtual_machines.run_command(
+                self.group_name, job_id, run_command_parameters).result()
+        except Exception as e:
+            state["errors"] += 1
+            logger.debug("Could not fetch logs from {}: {}".format(job_id, e))
+            if state["errors"] >= LOG_MAX_ERRORS:
+                logger.info("Giving up on logs of {} after {} failed fetches".format(
+                    job_id, state["errors"]))
+                self._close_logs_locked(job_id, state)
+            return 0
+
+        state["errors"] = 0
+        fetched = 0
+        message = "\n".join(status.message or '' for status in result.value or [])
+        for stream, size, encoded in _log_line.findall(message):
+            state["sizes"][stream] = int(size)
+            data = gzip.decompress(base64.b64decode(encoded)) if encoded else b''
+            if not data:
+                continue
+            with open(os.path.join(self.log_dir, "{}.{}".format(job_id, stream)), 'ab') as f:
+                f.write(data)
+            offsets[stream] += len(data)
+            fetched += len(data)
+            if offsets[stream] < int(size):
+                logger.debug("{} {} is {} bytes behind".format(
+                    job_id, stream, int(size) - offsets[stream]))
+        return fetched
+
     def create_nic(self, network_client):
-        """Create (or update, if it exists already) a Network Interface for a VM.
+        """Create a Network Interface for a VM with a statically assigned private IP.
 
             Also ensures that there's a virtual network available.
 
-            We create a VPC with CIDR 10.0.0.0/16, which provides up to 64,000 instances.
+            We create a VPC with CIDR `vnet_address_space` (10.0.0.0/16 by default), which
+            provides up to 64,000 instances.
 
-            We attach a subnet for each availability zone within the region specified in the
-            config. We give each subnet an ip range like 10.0.X.0/20, which is large enough
-            for approx. 4000 instances.
+            The vnet is carved into subnets of size `subnet_prefix_length` (10.0.X.0/20 by
+            default, large enough for approx. 4000 instances each). Private IPs are handed
+            out up front by the provider's AddressSpaceManager, and another subnet is
+            created whenever fewer than `subnet_headroom` addresses remain free.
 
+            If an address turns out to be taken by something discovery did not see, it
+            stays marked as used and the next address is tried.
+        """
+        while True:
+            subnet_id, private_ip = self.allocate_address()
 
+            logger.info('Creating (or updating) NIC with private IP {}'.format(private_ip))
+            try:
+                async_nic_creation = self.network_client.network_interfaces.\
+                    create_or_update(
+                        self.group_name,
+                        "{}.{}.nic".format(self.group_name, uuid.uuid4().hex), {
+                            'location':
+                            self.location,
+                            'ip_configurations': [{
+                                'name':
+                                "{}.ip.config".format(self.group_name),
+                                'private_ip_allocation_method':
+                                'Static',
+                                'private_ip_address':
+                                private_ip,
+                                'subnet': {
+                                    'id': subnet_id
+                                }
+                            }]
+                        })
+
+                nic_info = async_nic_creation.result()
+                break
+            except CloudError as e:
+                if "PrivateIPAddressInUse" in str(e):
+                    logger.warning('Private IP {} is already in use. Trying the next one.'.format(
+                        private_ip))
+                    continue
+                with self.address_space.lock:
+                    self.address_space.release(private_ip)
+                raise e
+            except Exception:
+                with self.address_space.lock:
+                    self.address_space.release(private_ip)
+                raise
+
+        self.resources.setdefault("nics", {})[nic_info.id] = nic_info
+
+        return nic_info
+
+    def allocate_address(self):
+        """Reserve a private IP, setting up the vnet and subnets as needed.
+
+        Returns
+        -------
+        (str, str)
+            The subnet id and the private IP address.
+        """
+        with self.address_space.lock:
+            if not self._network_ready:
+                self.create_vnet()
+                self.discover_subnets()
+                self._network_ready = True
+            if self.address_space.needs_subnet() and self.create_subnet() is None:
+                self.address_space.can_grow = False
+            allocation = self.address_space.allocate()
+
+        if allocation is None:
+            raise ScalingFailed(self.label, "No free private IPs left in vnet {}".format(
+                self.address_space.vnet))
+        return allocation
+
+    def delete_nic(self, nic_info):
+        """Delete a Network Interface and return its private IP to the pool.
+        """
+        logger.debug('Delete NIC {}'.format(nic_info.name))
+        async_nic_delete = self.network_client.network_interfaces.delete(
+            self.group_name, nic_info.name)
+        async_nic_delete.wait()
+        self.resources.get("nics", {}).pop(nic_info.id, None)
+
+        with self.address_space.lock:
+            for ip_config in nic_info.ip_configurations or []:
+                if ip_config.private_ip_address:
+                    self.address_space.release(ip_config.private_ip_address)
+
+    def create_vnet(self):
+        """Create (or update, if it exists already) the virtual network.
         """
         try:
             logger.info('Creating (or updating) Vnet')
@@ -389,7 +779,7 @@ class AzureProvider(ExecutionProvider, RepresentationMixin):
                     self.group_name, self.vnet_name, {
                         'location': self.location,
                         'address_space': {
-                            'address_prefixes': ['10.0.0.0/16']
+                            'address_prefixes': [str(self.address_space.vnet)]
                         }
                     })
             vnet_info = async_vnet_creation.result()
@@ -402,51 +792,72 @@ class AzureProvider(ExecutionProvider, RepresentationMixin):
             else:
                 raise e
 
-        if not self.resources.get("subnets", None):
-            self.resources["subnets"] = {}
+    def discover_subnets(self):
+        """Track the subnets that already exist in the vnet, and the private IPs in use in them.
+
+        This is done once, so that later NIC creation needs no lookups. Used addresses
+        come from each subnet's IP configurations, so NICs from any resource group are
+        counted. Configurations that are not on a NIC and do not report their address
+        (e.g. some load balancer frontends) are skipped.
+        """
+        self.resources.setdefault("subnets", {})
+
+        nics = {}
+        for subnet_info in self.network_client.subnets.list(self.group_name, self.vnet_name):
+            if not subnet_info.address_prefix:
+                continue
+            self.address_space.register(subnet_info.name, subnet_info.id,
+                                        subnet_info.address_prefix)
+            self.resources["subnets"][subnet_info.id] = subnet_info
+            logger.info('Found Existing Subnet {} ({}). Proceeding.'.format(
+                subnet_info.name, subnet_info.address_prefix))
+
+            for ip_config in subnet_info.ip_configurations or []:
+                private_ip = ip_config.private_ip_address
+                match = _nic_ip_config_id.match(ip_config.id or '')
+                if private_ip is None and match is not None:
+                    group, nic_name, config_name = match.groups()
+                    if (group, nic_name) not in nics:
+                        nics[(group, nic_name)] = self.network_client.network_interfaces.get(
+                            group, nic_name)
+                    for nic_config in nics[(group, nic_name)].ip_configurations or []:
+                        if nic_config.name.lower() == config_name.lower():
+                            private_ip = nic_config.private_ip_address
+                if private_ip:
+                    self.address_space.mark_used(private_ip)
+                else:
+                    logger.debug('Could not find private IP of {}'.format(ip_config.id))
+
+    def create_subnet(self):
+        """Create the next subnet in the vnet and start handing out its addresses.
+
+        Failing to create a subnet is only fatal when no free addresses are left.
+        """
+        prefix = self.address_space.next_prefix()
+        if prefix is None:
+            logger.warning('Vnet {} has no room for another subnet, {} private IPs left'.format(
+                self.address_space.vnet, self.address_space.free_count()))
+            return None
+
+        if self.address_space.subnets:
+            name = "{}.subnet.{}".format(self.group_name, prefix.replace("/", "-"))
+        else:
+            name = "{}.subnet".format(self.group_name)
 
         try:
-            logger.info('Creating (or updating) Subnet')
+            logger.info('Creating (or updating) Subnet {} ({})'.format(name, prefix))
             async_subnet_creation = self.network_client.subnets.create_or_update(
-                self.group_name, self.vnet_name, "{}.subnet".format(
-                    self.group_name), {'address_prefix': '10.0.0.0/20'})
+                self.group_name, self.vnet_name, name, {'address_prefix': prefix})
             subnet_info = async_subnet_creation.result()
-
-            self.resources["subnets"][subnet_info.id] = subnet_info
-
         except CloudError as e:
-            if "InUse" in str(e):
-                subnet_info = self.network_client.subnets.get(self.group_name, self.vnet_name, "{}.subnet".format(
-                        self.group_name))
-                self.resources["subnets"][subnet_info.id] = subnet_info
-                logger.info('Found Existing Subnet. Proceeding.')
-            else:
-                raise e
-
-        logger.info('Creating (or updating) NIC')
-        async_nic_creation = self.network_client.network_interfaces.\
-            create_or_update(
-                self.group_name,
-                "{}.{}.nic".format(self.group_name, time.time()), {
-                    'location':
-                    self.location,
-                    'ip_configurations': [{
-                        'name':
-                        "{}.ip.config".format(self.group_name),
-                        'subnet': {
-                            'id': subnet_info.id
-                        }
-                    }]
-                })
-
-        nic_info = async_nic_creation.result()
-
-        if not self.resources.get("nics", None):
-            self.resources["nics"] = {}
-
-        self.resources["nics"][nic_info.id] = nic_info
-
-        return nic_info
+            if self.address_space.free_count() > 0:
+                logger.warning('Could not create Subnet {}: {}'.format(name, e))
+                return None
+            raise e
+
+        self.address_space.register(subnet_info.name, subnet_info.id, prefix)
+        self.resources["subnets"][subnet_info.id] = subnet_info
+        return subnet_info
 
     def create_vm_parameters(self, nic_id, vm_reference):
         """Create the VM parameters structure.
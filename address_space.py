@@ -0,0 +1,129 @@
+import ipaddress
+import threading
+from collections import OrderedDict
+
+
+class AddressSpaceManager(object):
+    """Hand out static private IPs from a set of subnets carved out of one vnet.
+
+    The manager only does bookkeeping: the provider creates the subnets and NICs
+    and tells the manager about them. All methods are expected to be called while
+    holding `lock`, so that concurrent submits never hand out the same address.
+
+    Parameters
+    ----------
+    vnet_prefix : str
+        CIDR of the virtual network address space. Default is '10.0.0.0/16'.
+    subnet_prefix_length : int
+        Prefix length of each subnet carved from the vnet. Default is 20, which is
+        large enough for approx. 4000 instances per subnet.
+    headroom : int
+        When fewer than this many addresses are free across all subnets, a new
+        subnet should be created. Default is 64.
+
+    Raises
+    ------
+    ValueError
+        If `subnet_prefix_length` does not fit inside the vnet, or is longer than
+        the smallest subnet Azure allows.
+    """
+
+    # Azure reserves the network address, the first three host addresses
+    # and the broadcast address of every subnet.
+    RESERVED_HEAD = 4
+    RESERVED_TAIL = 1
+
+    # Azure does not allow subnets smaller than a /29
+    MAX_PREFIX_LENGTH = 29
+
+    def __init__(self, vnet_prefix='10.0.0.0/16', subnet_prefix_length=20, headroom=64):
+        self.vnet = ipaddress.ip_network(vnet_prefix)
+        if not self.vnet.prefixlen < subnet_prefix_length <= self.MAX_PREFIX_LENGTH:
+            raise ValueError("Subnet prefix length must be longer than /{} and at most /{}, got /{}".format(
+                self.vnet.prefixlen, self.MAX_PREFIX_LENGTH, subnet_prefix_length))
+        self.subnet_prefix_length = subnet_prefix_length
+        self.headroom = headroom
+        self.lock = threading.Lock()
+        # Cleared when creating a subnet fails, so it isn't retried on every allocation.
+        # Set again once an address is released or a subnet is registered.
+        self.can_grow = True
+        # subnet name -> {'id', 'network', 'used', 'cursor'}
+        self.subnets = OrderedDict()
+
+    def _usable_range(self, network):
+        first = int(network.network_address) + self.RESERVED_HEAD
+        last = int(network.broadcast_address) - self.RESERVED_TAIL
+        return first, last
+
+    def register(self, name, subnet_id, prefix, used=()):
+        """Start tracking a subnet, optionally seeded with addresses already in use."""
+        network = ipaddress.ip_network(prefix)
+        first, _ = self._usable_range(network)
+        self.subnets[name] = {
+            'id': subnet_id,
+            'network': network,
+            'used': set(),
+            'cursor': first
+        }
+        for ip in used:
+            self.mark_used(ip)
+        self.can_grow = True
+
+    def mark_used(self, ip):
+        """Record an address as taken. Addresses outside tracked subnets are ignored."""
+        addr = ipaddress.ip_address(ip)
+        for subnet in self.subnets.values():
+            if addr in subnet['network']:
+                subnet['used'].add(int(addr))
+                return True
+        return False
+
+    def release(self, ip):
+        """Return an address to the pool."""
+        addr = ipaddress.ip_address(ip)
+        for subnet in self.subnets.values():
+            if addr in subnet['network']:
+                subnet['used'].discard(int(addr))
+                subnet['cursor'] = min(subnet['cursor'], int(addr))
+                self.can_grow = True
+                return
+
+    def capacity(self, name):
+        first, last = self._usable_range(self.subnets[name]['network'])
+        return last - first + 1
+
+    def free_count(self):
+        """Number of unallocated addresses across all tracked subnets."""
+        return sum(self.capacity(name) - len(subnet['used'])
+                   for name, subnet in self.subnets.items())
+
+    def needs_subnet(self):
+        return self.can_grow and self.free_count() < self.headroom
+
+    def next_prefix(self):
+        """Return the next unused subnet CIDR in the vnet, or None if the vnet is full."""
+        taken = [subnet['network'] for subnet in self.subnets.values()]
+        for candidate in self.vnet.subnets(new_prefix=self.subnet_prefix_length):
+            if not any(candidate.overlaps(network) for network in taken):
+                return str(candidate)
+        return None
+
+    def allocate(self):
+        """Reserve a free address.
+
+        Returns
+        -------
+        (str, str) or None
+            The subnet id and the private IP address, or None if every tracked
+            subnet is full.
+        """
+        for subnet in self.subnets.values():
+            first, last = self._usable_range(subnet['network'])
+            addr = max(subnet['cursor'], first)
+            while addr <= last and addr in subnet['used']:
+                addr += 1
+            if addr <= last:
+                subnet['used'].add(addr)
+                subnet['cursor'] = addr + 1
+                return subnet['id'], str(ipaddress.ip_address(addr))
+        return None
@@ -13,3 +13,34 @@ then
     halt
 fi
 """
+
+# Runs the bootstrap script detached, so that the RunCommand extension is free
+# for log fetches and the worker isn't bound by the RunCommand timeout.
+bootstrap_string = """#!/bin/bash
+mkdir -p $log_dir
+cat > $log_dir/bootstrap.sh <<'PARSL_BOOTSTRAP_EOF'
+$script
+PARSL_BOOTSTRAP_EOF
+setsid nohup bash $log_dir/bootstrap.sh >>$log_dir/stdout.log 2>>$log_dir/stderr.log </dev/null &
+echo "parsl bootstrap started"
+"""
+
+# Prints the next chunk of each worker log, gzipped and base64 encoded. The chunk
+# is halved until it fits in the RunCommand output limit.
+log_fetch_string = """#!/bin/bash
+fetch() {{
+    f={log_dir}/$1.log
+    off=$2
+    n={chunk_size}
+    while :; do
+        d=$(tail -c +$((off + 1)) "$f" 2>/dev/null | head -c $n | gzip -c | base64 -w0)
+        if [ $(printf %s "$d" | wc -c) -le {max_encoded} ] || [ $n -le 256 ]; then
+            break
+        fi
+        n=$((n / 2))
+    done
+    echo "parsl-log $1 $(stat -c %s "$f" 2>/dev/null || echo 0) $d"
+}}
+fetch stdout {stdout_offset}
+fetch stderr {stderr_offset}
+"""
@@ -0,0 +1,123 @@
+import pytest
+
+from address_space import AddressSpaceManager
+
+
+def make_manager(headroom=4):
+    manager = AddressSpaceManager('10.0.0.0/24', subnet_prefix_length=28, headroom=headroom)
+    manager.register('a', 'id-a', manager.next_prefix())
+    return manager
+
+
+def test_reserved_addresses():
+    manager = make_manager()
+    # 16 addresses, minus the first four and the broadcast address
+    assert manager.capacity('a') == 11
+    assert manager.free_count() == 11
+
+    ips = [manager.allocate()[1] for _ in range(11)]
+    assert ips[0] == '10.0.0.4'
+    assert ips[-1] == '10.0.0.14'
+    assert manager.allocate() is None
+    assert manager.free_count() == 0
+
+
+def test_register_seeds_used_addresses():
+    manager = AddressSpaceManager('10.0.0.0/24', subnet_prefix_length=28)
+    manager.register('a', 'id-a', '10.0.0.0/28', used=['10.0.0.4', '10.0.0.6'])
+    assert manager.free_count() == 9
+    assert manager.allocate() == ('id-a', '10.0.0.5')
+    assert manager.allocate() == ('id-a', '10.0.0.7')
+
+
+def test_mark_used_outside_tracked_subnets():
+    manager = make_manager()
+    assert manager.mark_used('10.0.0.9')
+    assert not manager.mark_used('10.0.1.9')
+    assert manager.free_count() == 10
+
+
+def test_release_rewinds_cursor():
+    manager = make_manager()
+    for _ in range(5):
+        manager.allocate()
+    manager.release('10.0.0.5')
+    assert manager.free_count() == 7
+    assert manager.allocate() == ('id-a', '10.0.0.5')
+    assert manager.allocate() == ('id-a', '10.0.0.9')
+
+
+def test_release_unknown_address_is_ignored():
+    manager = make_manager()
+    manager.release('192.168.0.1')
+    manager.release('10.0.0.4')
+    assert manager.free_count() == 11
+
+
+def test_allocate_moves_to_next_subnet():
+    manager = make_manager()
+    for _ in range(11):
+        manager.allocate()
+    manager.register('b', 'id-b', manager.next_prefix())
+    assert manager.allocate() == ('id-b', '10.0.0.20')
+
+
+def test_headroom_trigger():
+    manager = make_manager(headroom=4)
+    for _ in range(7):
+        manager.allocate()
+        assert not manager.needs_subnet()
+    manager.allocate()
+    assert manager.free_count() == 3
+    assert manager.needs_subnet()
+
+
+def test_needs_subnet_without_subnets():
+    manager = AddressSpaceManager('10.0.0.0/24', subnet_prefix_length=28)
+    assert manager.needs_subnet()
+    assert manager.allocate() is None
+
+
+@pytest.mark.parametrize("registered, expected", [
+    ([], '10.0.0.0/28'),
+    (['10.0.0.0/28'], '10.0.0.16/28'),
+    # Subnets that don't line up with the prefix length still block their candidates
+    (['10.0.0.0/27'], '10.0.0.32/28'),
+    (['10.0.0.20/30'], '10.0.0.0/28'),
+    (['10.0.0.0/25', '10.0.0.128/26', '10.0.0.192/27', '10.0.0.224/28'], '10.0.0.240/28'),
+    (['10.0.0.0/24'], None),
+])
+def test_next_prefix(registered, expected):
+    manager = AddressSpaceManager('10.0.0.0/24', subnet_prefix_length=28)
+    for i, prefix in enumerate(registered):
+        manager.register(str(i), 'id-{}'.format(i), prefix)
+    assert manager.next_prefix() == expected
+
+
+@pytest.mark.parametrize("vnet_prefix, subnet_prefix_length", [
+    ('10.0.0.0/16', 8),
+    ('10.0.0.0/16', 16),
+    ('10.0.0.0/16', 30),
+])
+def test_invalid_subnet_prefix_length(vnet_prefix, subnet_prefix_length):
+    with pytest.raises(ValueError):
+        AddressSpaceManager(vnet_prefix, subnet_prefix_length)
+
+
+def test_failed_growth_is_not_retried():
+    manager = make_manager(headroom=4)
+    for _ in range(9):
+        manager.allocate()
+    assert manager.needs_subnet()
+
+    manager.can_grow = False
+    assert not manager.needs_subnet()
+
+    # Freeing an address allows another attempt
+    manager.release('10.0.0.4')
+    assert manager.needs_subnet()
+
+    manager.can_grow = False
+    manager.register('b', 'id-b', manager.next_prefix())
+    assert manager.can_grow
+    assert not manager.needs_subnet()
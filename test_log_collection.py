@@ -0,0 +1,248 @@
+import importlib
+import os
+import shutil
+import subprocess
+import sys
+import types
+
+import pytest
+
+import address_space
+import template
+
+pytestmark = pytest.mark.skipif(shutil.which('bash') is None, reason='needs bash')
+
+
+class Stub(object):
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+class CloudError(Exception):
+    pass
+
+
+def stub_modules():
+    """Minimal stand-ins for parsl and the Azure SDK, enough to import AzureProvider."""
+    modules = {
+        'parsl': {},
+        'parsl.dataflow': {},
+        'parsl.dataflow.error': {'ConfigurationError': type('ConfigurationError', (Exception,), {})},
+        'parsl.providers': {},
+        'parsl.providers.provider_base': {'ExecutionProvider': type('ExecutionProvider', (object,), {})},
+        'parsl.providers.error': {
+            'OptionalModuleMissing': type('OptionalModuleMissing', (Exception,), {}),
+            'ScalingFailed': type('ScalingFailed', (Exception,), {})
+        },
+        'parsl.utils': {'RepresentationMixin': type('RepresentationMixin', (object,), {})},
+        'parsl.launchers': {'SingleNodeLauncher': Stub},
+        'azure': {},
+        'azure.common': {},
+        'azure.common.credentials': {'ServicePrincipalCredentials': Stub},
+        'azure.mgmt': {},
+        'azure.mgmt.resource': {'ResourceManagementClient': Stub},
+        'azure.mgmt.network': {'NetworkManagementClient': Stub},
+        'azure.mgmt.compute': {'ComputeManagementClient': Stub},
+        'azure.mgmt.compute.models': {'DiskCreateOption': Stub},
+        'msrestazure': {},
+        'msrestazure.azure_exceptions': {'CloudError': CloudError},
+    }
+    stubs = {}
+    for name, attrs in modules.items():
+        module = types.ModuleType(name)
+        module.__dict__.update(attrs)
+        stubs[name] = module
+    stubs['parsl.providers.azure'] = types.ModuleType('parsl.providers.azure')
+    stubs['parsl.providers.azure.template'] = template
+    stubs['parsl.providers.azure.address_space'] = address_space
+    return stubs
+
+
+class Done(object):
+    """A finished LROPoller."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def done(self):
+        return True
+
+    def result(self):
+        return self
+
+    def wait(self):
+        pass
+
+
+class FakeVirtualMachines(object):
+    """Runs RunShellScript commands in a local bash."""
+
+    def __init__(self):
+        self.calls = 0
+        self.fail = False
+        self.deleted = []
+
+    def run_command(self, group_name, vm_name, parameters):
+        self.calls += 1
+        if self.fail:
+            raise CloudError('VM is gone')
+        stdout = subprocess.run(['bash', '-c', '\n'.join(parameters['script'])],
+                                stdout=subprocess.PIPE, check=True).stdout.decode()
+        # RunShellScript only returns the last 4096 bytes of output
+        assert len(stdout) < 4096
+        message = "Enable succeeded: \n[stdout]\n{}\n[stderr]\n".format(stdout)
+        return Done([types.SimpleNamespace(message=message)])
+
+    def delete(self, group_name, vm_name):
+        self.deleted.append(vm_name)
+        return Done(None)
+
+
+@pytest.fixture
+def azure_provider(monkeypatch):
+    for name, module in stub_modules().items():
+        monkeypatch.setitem(sys.modules, name, module)
+    monkeypatch.delitem(sys.modules, 'AzureProvider', raising=False)
+    return importlib.import_module('AzureProvider')
+
+
+@pytest.fixture
+def remote(tmp_path, azure_provider, monkeypatch):
+    remote = tmp_path / 'remote'
+    remote.mkdir()
+    monkeypatch.setattr(azure_provider, 'REMOTE_LOG_DIR', str(remote))
+    return remote
+
+
+@pytest.fixture
+def provider(tmp_path, azure_provider, monkeypatch):
+    for var in ('AZURE_CLIENT_ID', 'AZURE_CLIENT_SECRET', 'AZURE_TENANT_ID', 'AZURE_SUBSCRIPTION_ID'):
+        monkeypatch.setenv(var, 'x')
+    provider = azure_provider.AzureProvider({}, log_dir=str(tmp_path / 'logs'))
+    provider.compute_client = types.SimpleNamespace(virtual_machines=FakeVirtualMachines())
+    provider.vm_status = 'RUNNING'
+    provider.status = lambda job_ids: [provider.vm_status for _ in job_ids]
+    # Polled explicitly by the tests
+    provider.start_log_collection = lambda: None
+    provider.track_logs('job', Done([types.SimpleNamespace(message='parsl bootstrap started')]))
+    return provider
+
+
+def text_log(lines):
+    return ''.join('{} Setting up python3-pip ...\n'.format(i) for i in range(lines)).encode()
+
+
+def local(provider, stream):
+    with open(os.path.join(provider.log_dir, 'job.{}'.format(stream)), 'rb') as f:
+        return f.read()
+
+
+def collect_all(provider):
+    while provider.collect_logs(['job']).get('job'):
+        pass
+
+
+def test_chunks_fit_output_limit(provider, remote):
+    data = os.urandom(50000)
+    (remote / 'stdout.log').write_bytes(data)
+    provider.log_fetches_per_poll = 1
+
+    fetched = provider.collect_logs()['job']
+    # Incompressible output is halved until it fits
+    assert 0 < fetched < provider.log_chunk_size
+    assert local(provider, 'stdout') == data[:fetched]
+
+
+def test_logs_match_remote(provider, remote):
+    stdout = text_log(5000)
+    stderr = os.urandom(5000)
+    (remote / 'stdout.log').write_bytes(stdout)
+    (remote / 'stderr.log').write_bytes(stderr)
+
+    collect_all(provider)
+    assert local(provider, 'stdout') == stdout
+    assert local(provider, 'stderr') == stderr
+    with open(os.path.join(provider.log_dir, 'job.runcommand.log')) as f:
+        assert f.read() == 'parsl bootstrap started'
+
+    state = provider.resources['logs']['job']
+    assert state['sizes'] == {'stdout': len(stdout), 'stderr': len(stderr)}
+    assert provider._logs_behind(state) == 0
+
+
+def test_logs_are_fetched_incrementally(provider, remote):
+    (remote / 'stdout.log').write_bytes(b'first\n')
+    collect_all(provider)
+    with open(str(remote / 'stdout.log'), 'ab') as f:
+        f.write(b'second\n')
+    collect_all(provider)
+    assert local(provider, 'stdout') == b'first\nsecond\n'
+
+
+def test_fetches_per_poll(provider, remote):
+    (remote / 'stdout.log').write_bytes(os.urandom(50000))
+    vms = provider.compute_client.virtual_machines
+
+    provider.log_fetches_per_poll = 3
+    provider.collect_logs()
+    assert vms.calls == 3
+
+
+def test_drain_logs(provider, remote):
+    stdout = text_log(5000)
+    (remote / 'stdout.log').write_bytes(stdout)
+
+    assert provider.drain_logs(['job', 'missing']) == {'job': 0, 'missing': None}
+    assert local(provider, 'stdout') == stdout
+
+
+def test_drain_logs_timeout(provider, remote):
+    stdout = os.urandom(50000)
+    (remote / 'stdout.log').write_bytes(stdout)
+
+    remaining = provider.drain_logs(['job'], timeout=0)['job']
+    assert remaining == len(stdout) - len(local(provider, 'stdout'))
+    assert remaining > 0
+
+
+def test_closed_after_errors(azure_provider, provider, remote):
+    vms = provider.compute_client.virtual_machines
+    vms.fail = True
+
+    for _ in range(azure_provider.LOG_MAX_ERRORS - 1):
+        provider.collect_logs()
+    assert 'job' in provider.resources['logs']
+
+    provider.collect_logs()
+    assert 'job' not in provider.resources['logs']
+    assert provider.collect_logs() == {}
+    assert vms.calls == azure_provider.LOG_MAX_ERRORS
+
+
+def test_closed_after_vm_stops(provider, remote):
+    (remote / 'stdout.log').write_bytes(b'done\n')
+    collect_all(provider)
+    assert 'job' in provider.resources['logs']
+
+    provider.vm_status = 'COMPLETED'
+    provider.collect_logs()
+    assert 'job' not in provider.resources['logs']
+
+
+def test_not_closed_while_behind(provider, remote):
+    (remote / 'stdout.log').write_bytes(os.urandom(50000))
+    provider.vm_status = 'COMPLETED'
+    provider.log_fetches_per_poll = 1
+    provider.collect_logs()
+    assert 'job' in provider.resources['logs']
+
+
+def test_cancel_drains_and_closes_logs(provider, remote):
+    stdout = text_log(5000)
+    (remote / 'stdout.log').write_bytes(stdout)
+    provider.instances.append('job')
+
+    assert provider.cancel(['job']) == [True]
+    assert local(provider, 'stdout') == stdout
+    assert 'job' not in provider.resources['logs']
+    assert provider.compute_client.virtual_machines.deleted == ['job']